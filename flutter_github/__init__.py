@@ -1,82 +1,152 @@
 import re
 import os
+import json
+import mmap
 import glob
-import shutil
 import typing
+import hashlib
+import pathlib
 import logging
+import concurrent.futures
 
 import requests
-import petitparser
-import marko.block
-import marko.inline
-import marko.parser
+import requests.adapters
+
+
+T = typing.TypeVar("T")
+
+
+def constant(call: typing.Callable[[], T]) -> T:
+    return call()
+
+
+@constant
+def SESSION() -> requests.Session:
+    adapter = requests.adapters.HTTPAdapter(pool_connections=64, pool_maxsize=64)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    return session
 
 
 def download_file_from_url(url: str, path: str, force: bool = False) -> bool:
     if not force and os.path.exists(path):
         return True
 
-    response = requests.get(url, stream=True)
+    response = SESSION.get(url)
     if not response.ok:
         return False
 
-    try:
-        os.makedirs(os.path.dirname(path))
-    except FileExistsError:
-        pass
-
-    with open(path, "wb+") as f:
-        response.raw.decode_content = True
-        shutil.copyfileobj(response.raw, f)
+    file_path = pathlib.Path(path)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    file_path.write_bytes(response.content)
 
     return True
 
 
-def decode_links(path: str) -> typing.Iterator[str]:
-    parser = marko.parser.Parser()
-    with open(path, encoding="utf-8") as f:
-        document = parser.parse(f.read())
+def write_json(path: str, data: typing.Any) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=4, sort_keys=True)
 
-    current_section_name: str | None = None
-    sections: set[str] = set()
-    for node in document.children:
-        match node:
-            case marko.block.Heading():
-                (text_node,) = node.children
-                assert isinstance(text_node, marko.inline.RawText)
+    os.replace(tmp_path, path)
 
-                title = text_node.children
-                current_section_name = title
 
-            case marko.block.List():
-                if current_section_name == "Contents":
-                    for li_node in node.children:
-                        assert isinstance(li_node, marko.block.ListItem)
-                        (p_node,) = li_node.children
+MARKDOWN_LINE_GRAMMAR = re.compile(
+    rb"^(?:#+[ \t]+(?P<heading>.+?)"
+    rb"|[ \t]*[-*+][ \t]+\[(?P<title>[^\]\n]+)\]\((?P<dest>[^)\s]+).*?)"
+    rb"[ \t]*\r?$",
+    re.MULTILINE,
+)
 
-                        assert isinstance(p_node, marko.block.Paragraph)
-                        (a_node,) = p_node.children
 
-                        assert isinstance(a_node, marko.inline.Link)
-                        (text_node,) = typing.cast(list, a_node.children)
+def decode_links(path: str) -> typing.Iterator[str]:
+    current_section_name: str | None = None
+    sections: set[str] = set()
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            for match in MARKDOWN_LINE_GRAMMAR.finditer(m):
+                if (heading := match["heading"]) is not None:
+                    current_section_name = heading.decode("utf-8")
 
-                        assert isinstance(text_node, marko.inline.RawText)
-                        section_title = text_node.children
-                        sections.add(section_title.lower())
+                elif current_section_name == "Contents":
+                    sections.add(match["title"].decode("utf-8").lower())
 
                 elif current_section_name:
                     assert (
                         current_section_name.lower() in sections
                     ), f"Invalid section: {current_section_name}"
-                    for li_node in node.children:
-                        assert isinstance(li_node, marko.block.ListItem)
-                        (p_node,) = li_node.children
+                    yield match["dest"].decode("utf-8")
+
+
+def load_links(path: str) -> list[str]:
+    with open(path, "rb") as f:
+        digest = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+    cache_path = os.path.join(os.path.dirname(path), f"links.{digest}.json")
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+
+    links = list(decode_links(path))
+    write_json(cache_path, links)
+
+    return links
 
-                        assert isinstance(p_node, marko.block.Paragraph)
-                        link_node, *_ = p_node.children
 
-                        assert isinstance(link_node, marko.inline.Link)
-                        yield link_node.dest
+def get_default_branch(user_name: str, repo_name: str) -> str | None:
+    headers: dict[str, str] = {}
+    if token := os.environ.get("GH_TOKEN"):
+        headers["Authorization"] = f"token {token}"
+
+    try:
+        response = SESSION.get(
+            f"https://api.github.com/repos/{user_name}/{repo_name}", headers=headers
+        )
+        if not response.ok:
+            return None
+
+        return response.json()["default_branch"]
+    except (requests.RequestException, ValueError, KeyError):
+        return None
+
+
+def download_buildgradle(
+    user_name: str,
+    repo_name: str,
+    monorepo_path: str,
+    default_branches: dict[str, str],
+    downloaded_files: frozenset[str],
+) -> bool:
+    buildgradle_name = f"{user_name}_{repo_name}.build.gradle"
+    if buildgradle_name in downloaded_files:
+        return True
+
+    repo_id = f"{user_name}/{repo_name}"
+    default_branch = default_branches.get(repo_id) or get_default_branch(
+        user_name, repo_name
+    )
+
+    branch_names: tuple[str, ...]
+    if default_branch is None:
+        branch_names = ("main", "master", "develop")
+    else:
+        default_branches[repo_id] = default_branch
+        branch_names = (default_branch,)
+
+    for branch_name in branch_names:
+        buildgradle_url = f"https://raw.githubusercontent.com/{user_name}/{repo_name}/{branch_name}/{monorepo_path}android/app/build.gradle"
+        if download_file_from_url(
+            buildgradle_url, f"build/files/{buildgradle_name}", force=True
+        ):
+            return True
+
+    return False
 
 
 def download_repos() -> None:
@@ -99,43 +169,54 @@ def download_repos() -> None:
         ("immich-app", "immich"): "mobile",
     }
 
-    for link in decode_links(source_path):
-        _, _, _, user_name, repo_name, *_ = link.split("/", 5)
-        monorepo_path: str = monorepos.get((user_name, repo_name), "")
-        if monorepo_path:
-            monorepo_path = f"{monorepo_path}/"
-
-        for branch_name in ("main", "master", "develop"):
-            buildgradle_url = f"https://raw.githubusercontent.com/{user_name}/{repo_name}/{branch_name}/{monorepo_path}android/app/build.gradle"
-            buildgradle_path = f"build/files/{user_name}_{repo_name}.build.gradle"
-            if download_file_from_url(buildgradle_url, buildgradle_path):
-                break
-
-        else:
-            logging.debug(f"build.gradle not found for {link}")
+    default_branches_path = "build/default_branches.json"
+    default_branches: dict[str, str]
+    try:
+        with open(default_branches_path, encoding="utf-8") as f:
+            default_branches = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        default_branches = {}
 
+    downloaded_files: frozenset[str]
+    try:
+        downloaded_files = frozenset(os.listdir("build/files"))
+    except FileNotFoundError:
+        downloaded_files = frozenset()
+
+    futures: dict[str, concurrent.futures.Future[bool]] = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=32) as executor:
+        for link in load_links(source_path):
+            _, _, _, user_name, repo_name, *_ = link.split("/", 5)
+            monorepo_path: str = monorepos.get((user_name, repo_name), "")
+            if monorepo_path:
+                monorepo_path = f"{monorepo_path}/"
+
+            futures[link] = executor.submit(
+                download_buildgradle,
+                user_name,
+                repo_name,
+                monorepo_path,
+                default_branches,
+                downloaded_files,
+            )
 
-NEW_LINE_GRAMMAR = petitparser.character.of("\n") & petitparser.character.of(" ").star()
+    write_json(default_branches_path, default_branches)
 
-T = typing.TypeVar("T")
+    for link, future in futures.items():
+        if not future.result():
+            logging.debug(f"build.gradle not found for {link}")
 
 
-def constant(call: typing.Callable[[], T]) -> T:
-    return call()
+NEW_LINE_GRAMMAR = r"\n *"
 
 
 @constant
-def COMMENT_GRAMMAR():
-    return (
-        petitparser.character.of(" ").star()
-        & petitparser.string.of("//")
-        & petitparser.character.none_of("\n").star()
-        & petitparser.character.of("\n")
-    )
+def COMMENT_GRAMMAR() -> re.Pattern[str]:
+    return re.compile(r" *//[^\n]*\n")
 
 
 @constant
-def OLD_PLUGINS_DECLARATION_GRAMMAR():
+def OLD_PLUGINS_DECLARATION_GRAMMAR() -> re.Pattern[str]:
     """
     Parses the old `plugins` declaration.
 
@@ -150,169 +231,165 @@ def OLD_PLUGINS_DECLARATION_GRAMMAR():
     }
     ```
     """
-    plugin_declaration_grammar = (
-        petitparser.string.of("id ")
-        & petitparser.character.any_of("'\"")
-        & petitparser.character.none_of("'\"").plus()
-        & petitparser.character.any_of("'\"")
-    )
+    plugin_declaration_grammar = r"id ['\"][^'\"]+['\"]"
 
-    return (
-        petitparser.string.of("plugins {")
-        & NEW_LINE_GRAMMAR
-        & (plugin_declaration_grammar & NEW_LINE_GRAMMAR).plus()
-        & petitparser.string.of("}\n")
+    return re.compile(
+        r"plugins \{"
+        + NEW_LINE_GRAMMAR
+        + rf"(?:{plugin_declaration_grammar}{NEW_LINE_GRAMMAR})+"
+        + r"\}\n"
     )
 
 
 @typing.overload
-def build_flutter_property_grammar(name: str, key: str):
+def build_flutter_property_grammar(name: str, key: str) -> re.Pattern[str]:
     ...
 
 
 @typing.overload
-def build_flutter_property_grammar(name: str, key: str, label: str, description: str):
+def build_flutter_property_grammar(
+    name: str, key: str, label: str, description: str
+) -> re.Pattern[str]:
     ...
 
 
-def build_flutter_property_grammar(name: str, key: str, *args: str):
+def build_flutter_property_grammar(name: str, key: str, *args: str) -> re.Pattern[str]:
     if args:
         label, description = args
-        body_grammar = (
-            petitparser.string.of("throw")
-            & petitparser.string.of(" new").optional()
-            & petitparser.string.of(" ")
-            & (
-                petitparser.string.of("GradleException")
-                | petitparser.string.of("FileNotFoundException")
-            )
-            & petitparser.string.of(
-                f'("{label} not found. Define {description.format(key)} in the local.properties file.")'
-            )
+        body_grammar = r"throw(?: new)? (?:GradleException|FileNotFoundException)" + re.escape(
+            f'("{label} not found. Define {description.format(key)} in the local.properties file.")'
         )
     else:
-        body_grammar = (
-            petitparser.string.of(f"{name} = ")
-            & petitparser.character.any_of("'\"")
-            & petitparser.character.none_of("'\"").plus()
-            & petitparser.character.any_of("'\"")
-        )
-
-    return (
-        petitparser.string.of(f"def {name} = localProperties.getProperty('{key}')")
-        & NEW_LINE_GRAMMAR
-        & petitparser.string.of(f"if ({name} == null) {{")
-        & NEW_LINE_GRAMMAR
-        & body_grammar
-        & NEW_LINE_GRAMMAR
-        & petitparser.string.of("}\n")
+        body_grammar = re.escape(f"{name} = ") + r"['\"][^'\"]+['\"]"
+
+    return re.compile(
+        re.escape(f"def {name} = localProperties.getProperty('{key}')")
+        + NEW_LINE_GRAMMAR
+        + re.escape(f"if ({name} == null) {{")
+        + NEW_LINE_GRAMMAR
+        + body_grammar
+        + NEW_LINE_GRAMMAR
+        + r"\}\n"
     )
 
 
-def build_properties_file_load_grammar(variable: str, file_variable: str, name: str):
-    return (
-        petitparser.string.of(f"def {variable} = new Properties()")
-        & NEW_LINE_GRAMMAR
-        & petitparser.string.of(f"def {file_variable} = rootProject.file('{name}')")
-        & NEW_LINE_GRAMMAR
-        & petitparser.string.of(f"if ({file_variable}.exists()) {{")
-        & NEW_LINE_GRAMMAR
-        & petitparser.string.of(f"{file_variable}.")
-        & (
-            petitparser.string.of("withReader('UTF-8') { reader ->")
-            | petitparser.string.of("withInputStream { stream ->")
-        )
-        & NEW_LINE_GRAMMAR
-        & petitparser.string.of(f"{variable}.load(")
-        & (petitparser.string.of("reader") | petitparser.string.of("stream"))
-        & petitparser.string.of(")")
-        & NEW_LINE_GRAMMAR
-        & petitparser.string.of("}\n}\n")
+def build_properties_file_load_grammar(
+    variable: str, file_variable: str, name: str
+) -> re.Pattern[str]:
+    return re.compile(
+        re.escape(f"def {variable} = new Properties()")
+        + NEW_LINE_GRAMMAR
+        + re.escape(f"def {file_variable} = rootProject.file('{name}')")
+        + NEW_LINE_GRAMMAR
+        + re.escape(f"if ({file_variable}.exists()) {{")
+        + NEW_LINE_GRAMMAR
+        + re.escape(f"{file_variable}.")
+        + r"(?:withReader\('UTF-8'\) \{ reader ->|withInputStream \{ stream ->)"
+        + NEW_LINE_GRAMMAR
+        + re.escape(f"{variable}.load(")
+        + r"(?:reader|stream)\)"
+        + NEW_LINE_GRAMMAR
+        + r"\}\n\}\n"
     )
 
 
 class Section(typing.NamedTuple):
-    grammar: petitparser.parser.Parser[str]
+    grammar: re.Pattern[str]
     is_persistent: bool
     is_required: bool
 
 
-def main() -> None:
-    # download_repos()
-
-    for fpath in map(os.path.normpath, glob.glob("build/files/*.build.gradle")):
-        sections: dict[str, Section] = {
-            "comment": Section(
-                grammar=COMMENT_GRAMMAR,
-                is_persistent=True,
-                is_required=False,
-            ),
-            "newline": Section(
-                grammar=petitparser.character.of("\n").plus(),
-                is_persistent=True,
-                is_required=False,
-            ),
-            "old_plugins": Section(
-                grammar=OLD_PLUGINS_DECLARATION_GRAMMAR,
-                is_persistent=False,
-                is_required=False,
-            ),
-            "localProperties": Section(
-                grammar=build_properties_file_load_grammar(
-                    "localProperties", "localPropertiesFile", "local.properties"
-                ),
-                is_persistent=False,
-                is_required=True,
+@constant
+def SECTIONS() -> dict[str, Section]:
+    return {
+        "comment": Section(
+            grammar=COMMENT_GRAMMAR,
+            is_persistent=True,
+            is_required=False,
+        ),
+        "newline": Section(
+            grammar=re.compile(r"\n+"),
+            is_persistent=True,
+            is_required=False,
+        ),
+        "old_plugins": Section(
+            grammar=OLD_PLUGINS_DECLARATION_GRAMMAR,
+            is_persistent=False,
+            is_required=False,
+        ),
+        "localProperties": Section(
+            grammar=build_properties_file_load_grammar(
+                "localProperties", "localPropertiesFile", "local.properties"
             ),
-            "keystoreProperties": Section(
-                grammar=build_properties_file_load_grammar(
-                    "keystoreProperties", "keystorePropertiesFile", "key.properties"
-                ),
-                is_persistent=False,
-                is_required=False,
+            is_persistent=False,
+            is_required=True,
+        ),
+        "keystoreProperties": Section(
+            grammar=build_properties_file_load_grammar(
+                "keystoreProperties", "keystorePropertiesFile", "key.properties"
             ),
-            "flutterRoot": Section(
-                grammar=build_flutter_property_grammar(
-                    "flutterRoot",
-                    "flutter.sdk",
-                    "Flutter SDK",
-                    "location with {}",
-                ),
-                is_persistent=False,
-                is_required=True,
+            is_persistent=False,
+            is_required=False,
+        ),
+        "flutterRoot": Section(
+            grammar=build_flutter_property_grammar(
+                "flutterRoot",
+                "flutter.sdk",
+                "Flutter SDK",
+                "location with {}",
             ),
-        }
-        with open(fpath, encoding="utf-8") as f:
-            text = f.read()
+            is_persistent=False,
+            is_required=True,
+        ),
+    }
 
-            sections_found: list[str] = []
-            while not sections_found or not all(
-                (section := sections[section_id]).is_persistent
-                or not section.is_required
-                for section_id in (set(sections.keys()) - set(sections_found))
-            ):
-                found = False
-                for section_id, section in sections.items():
-                    result = section.grammar.token().parse(text)
-                    if not result.is_success:
-                        # print(fpath, section_id, result.message, f"{text[:30]!r}")
-                        continue
-                    token = result.value
-                    text = text[token.stop :]
-                    sections_found.append(section_id)
-                    found = True
-                    break
 
-                if not found:
-                    # print(fpath)
-                    break
+SECTION_BITS: typing.Final[dict[str, int]] = {
+    section_id: 1 << i for i, section_id in enumerate(SECTIONS)
+}
 
+REQUIRED_SECTIONS_MASK: typing.Final[int] = sum(
+    SECTION_BITS[section_id]
+    for section_id, section in SECTIONS.items()
+    if section.is_required and not section.is_persistent
+)
 
 
+SECTIONS_GRAMMAR: typing.Final[re.Pattern[str]] = re.compile(
+    "|".join(
+        f"(?P<{section_id}>{section.grammar.pattern})"
+        for section_id, section in SECTIONS.items()
+    )
+)
+
+
+def process_file(fpath: str) -> tuple[str, list[str]]:
+    with open(fpath, encoding="utf-8") as f:
+        text = f.read()
+
+    sections_found: list[str] = []
+    found_mask = 0
+    position = 0
+    while found_mask & REQUIRED_SECTIONS_MASK != REQUIRED_SECTIONS_MASK:
+        match = SECTIONS_GRAMMAR.match(text, position)
+        if match is None:
+            # print(fpath, f"{text[position:position + 30]!r}")
+            break
+
+        section_id = typing.cast(str, match.lastgroup)
+        position = match.end()
+        sections_found.append(section_id)
+        found_mask |= SECTION_BITS[section_id]
 
+    return fpath, sections_found
 
 
-            print(fpath, sections_found)
+def main() -> None:
+    # download_repos()
+
+    for fpath in map(os.path.normpath, glob.glob("build/files/*.build.gradle")):
+        fpath, sections_found = process_file(fpath)
+        print(fpath, sections_found)
 
 
 if __name__ == "__main__":